@@ -30,13 +30,17 @@ import efel
 import os
 import logging
 import gzip
+import hashlib
 import json
 import pprint
+import importlib
+import tempfile
 
 from itertools import cycle
 from collections import OrderedDict
 
 
+from . import __version__
 from . import tools
 from .tools import tabletools
 from . import plottools
@@ -48,6 +52,83 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(stream=sys.stdout)
 logger = logging.getLogger()
 
+# trace formats, each one read by the module of the same name in formats
+READERS = ('igor', 'axon', 'csv_lccr', 'spike2', 'ibf_json')
+
+
+def feature_mean(values):
+    """Mean of the values of a feature for one trace. Most features have a
+    single value per trace, for which the numpy.mean machinery is skipped"""
+    if isinstance(values, (list, numpy.ndarray)) and len(values) == 1:
+        return numpy.float64(values[0])
+    else:
+        return numpy.mean(values)
+
+
+def efel_settings_snapshot():
+    """All the settings currently used by eFEL, including the ones not set
+    through the extractor"""
+    snapshot = []
+    for name in ('_int_settings', '_double_settings', '_string_settings'):
+        snapshot.append(sorted(getattr(efel.api, name, {}).items()))
+    settings = getattr(efel.api, '_settings', None)
+    if settings is not None:
+        snapshot.append(sorted(vars(settings).items()))
+
+    return snapshot
+
+
+def features_cache_key(traces, settings):
+    """Key of the cached features of an experiment: hash of the traces given
+    to eFEL, of the settings used to extract the features from them and of
+    the versions of eFEL and BluePyEfe"""
+    key = hashlib.md5(repr((
+        efel.__version__, __version__, efel_settings_snapshot(),
+        settings)).encode('utf-8'))
+    for trace in traces:
+        key.update(repr((trace['stim_start'], trace['stim_end'],
+                         trace['stimulus_current'])).encode('utf-8'))
+        key.update(numpy.ascontiguousarray(trace['T']).tobytes())
+        key.update(numpy.ascontiguousarray(trace['V']).tobytes())
+
+    return key.hexdigest()
+
+
+def load_features_cache(filename, feature_names):
+    """Load cached features, returns None if the file is missing or cannot
+    be read"""
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        with numpy.load(filename) as cached:
+            features = OrderedDict(
+                (feature, cached[feature].tolist())
+                for feature in feature_names)
+    except Exception:
+        logger.warning(" Ignoring unreadable cache file %s", filename)
+        return None
+
+    logger.info(" Loading features from %s", filename)
+    return features
+
+
+def save_features_cache(filename, features):
+    """Save features to the cache. The file is written under a temporary
+    name and then moved, so that an interrupted run leaves no truncated
+    file behind"""
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename), suffix='.npz.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            numpy.savez(f, **features)
+        # os.replace does not exist in Python 2, where rename overwrites
+        # the destination on POSIX
+        getattr(os, 'replace', os.rename)(tmp_filename, filename)
+    except Exception:
+        os.remove(tmp_filename)
+        raise
+
 
 class Extractor(object):
 
@@ -70,11 +151,12 @@ class Extractor(object):
         self.options = config['options']
 
         for experiment in self.features:
-            f = self.features[experiment]
-            self.features[experiment] = sorted(
-                set(f), key=lambda x: f.index(x))
+            # remove duplicates, keeping the order of first appearance
+            self.features[experiment] = list(
+                OrderedDict.fromkeys(self.features[experiment]))
 
         self.format = config['format']
+        self.reader = None
 
         self.dataset = OrderedDict()
         self.dataset_mean = OrderedDict()
@@ -83,15 +165,13 @@ class Extractor(object):
 
         conv_fact = 1
 
-        if "relative" not in self.options:
-            self.options["relative"] = False
+        self.options.setdefault("relative", False)
 
-        if "amp_min" not in self.options:
-            self.options["amp_min"] = 0.001  # minimum current amplitude used
+        # minimum current amplitude used
+        self.options.setdefault("amp_min", 0.001)
 
-        if "peak_min" not in self.options:
-            # minimum current amplitude used for spike detection
-            self.options["peak_min"] = 0.001
+        # minimum current amplitude used for spike detection
+        self.options.setdefault("peak_min", 0.001)
 
         if "target" not in self.options:
             self.options["target"] = [100., 150., 200., 250.]
@@ -106,11 +186,8 @@ class Extractor(object):
                         self.options["target"]]
                     self.options["target"] = conv_target
 
-        if "tolerance" not in self.options:
-            self.options["tolerance"] = 10
-
-        if "strict_stiminterval" not in self.options:
-            self.options["strict_stiminterval"] = {'base': False}
+        self.options.setdefault("tolerance", 10)
+        self.options.setdefault("strict_stiminterval", {'base': False})
 
         if isinstance(self.options["tolerance"], list) is False:
             if conv_fact != 1:
@@ -123,26 +200,13 @@ class Extractor(object):
             self.options["tolerance"] = \
                 [x * conv_fact for x in self.options["tolerance"]]
 
-        if "nanmean" not in self.options:
-            self.options["nanmean"] = False
-
-        if "nanmean_cell" not in self.options:
-            self.options["nanmean_cell"] = True
-
-        if "nangrace" not in self.options:
-            self.options["nangrace"] = 0
-
-        if "delay" not in self.options:
-            self.options["delay"] = 0
-
-        if "posttime" not in self.options:
-            self.options["posttime"] = 200
-
-        if "spike_threshold" not in self.options:
-            self.options["spike_threshold"] = 2
-
-        if "logging" not in self.options:
-            self.options["logging"] = False
+        self.options.setdefault("nanmean", False)
+        self.options.setdefault("nanmean_cell", True)
+        self.options.setdefault("nangrace", 0)
+        self.options.setdefault("delay", 0)
+        self.options.setdefault("posttime", 200)
+        self.options.setdefault("spike_threshold", 2)
+        self.options.setdefault("logging", False)
 
         if self.options["logging"]:
             logger.setLevel(logging.INFO)
@@ -188,9 +252,9 @@ class Extractor(object):
         self.thresholds_per_cell = OrderedDict()
         self.hypamps_per_cell = OrderedDict()
 
-        self.extra_features = ['spikerate_tau_jj', 'spikerate_drop',
-                               'spikerate_tau_log', 'spikerate_tau_fit',
-                               'spikerate_tau_slope']
+        self.extra_features = frozenset([
+            'spikerate_tau_jj', 'spikerate_drop', 'spikerate_tau_log',
+            'spikerate_tau_fit', 'spikerate_tau_slope'])
 
     def newmeancell(self, a):
         if (self.options["nanmean_cell"] or
@@ -243,10 +307,7 @@ class Extractor(object):
             v_corr = self.cells[cellname]['v_corr']
             self.dataset[cellname]['v_corr'] = v_corr
 
-            if 'ljp' in self.cells[cellname]:
-                ljp = self.cells[cellname]['ljp']
-            else:
-                ljp = 0
+            ljp = self.cells[cellname].get('ljp', 0)
             self.dataset[cellname]['ljp'] = ljp
 
             dataset_cell_exp = OrderedDict()
@@ -258,12 +319,8 @@ class Extractor(object):
                 files = self.cells[cellname]['experiments'][expname]['files']
 
                 # read stimulus features if present
-                stim_feats = []
-                if 'stim_feats' in self.cells[cellname]['experiments'][
-                        expname]:
-                    stim_feats = \
-                        self.cells[cellname][
-                            'experiments'][expname]['stim_feats']
+                stim_feats = self.cells[cellname]['experiments'][
+                    expname].get('stim_feats', [])
 
                 if len(files) > 0:
                     logger.debug(" Adding experiment %s", expname)
@@ -318,23 +375,16 @@ class Extractor(object):
 
     def process_file(self, **kwargs):
         """Get data from a trace file"""
-        if self.format == 'igor':
-            from .formats import igor
-            return igor.process(**kwargs)
-        elif self.format == 'axon':
-            from .formats import axon
-            return axon.process(**kwargs)
-        elif self.format == 'csv_lccr':
-            from .formats import csv_lccr
-            return csv_lccr.process(**kwargs)
-        elif self.format == 'spike2':
-            from .formats import spike2
-            return spike2.process(**kwargs)
-        elif self.format == 'ibf_json':
-            from .formats import ibf_json
-            return ibf_json.process(**kwargs)
-        else:
-            raise ValueError('Unrecognized trace format: %s' % self.format)
+        if self.reader is None:
+            # the format is the same for all the files, resolve the reader
+            # only once
+            if self.format not in READERS:
+                raise ValueError(
+                    'Unrecognized trace format: %s' % self.format)
+            self.reader = importlib.import_module(
+                '.formats.' + self.format, __package__).process
+
+        return self.reader(**kwargs)
 
     def plt_traces(self):
         """Plot traces"""
@@ -443,6 +493,16 @@ class Extractor(object):
                         dirname + '/' + figname + '.pdf', dpi=300)
                     plt.close(fig['fig'])
 
+    def split_features(self, features):
+        """Get the features to extract for an experiment (with peak_time,
+        needed to count the spikes) and the subset of them computed by eFEL
+        (the extra features are computed from the peak times)"""
+        features_all = tuple(features) + ('peak_time',)
+        efel_features = tuple(
+            f for f in features_all if f not in self.extra_features)
+
+        return features_all, efel_features
+
     def extract_features(self, threshold=-20):
         """Extract features from the traces"""
         logger.info(" Extracting features")
@@ -469,6 +529,26 @@ class Extractor(object):
         else:
             ZERO_TO_NAN = False
 
+        if ZERO_TO_NAN:
+            no_zeros_features = frozenset(
+                self.options['zero_to_nan']['mean_features_no_zeros'])
+        else:
+            no_zeros_features = frozenset()
+
+        trace_check = not ("trace_check" in self.options and
+                           self.options["trace_check"] is False)
+
+        # if a cache directory is given, the features of each experiment are
+        # stored there and reused as long as traces and settings are the same
+        cache_dir = self.options.get("cache_dir")
+        if cache_dir is not None:
+            tools.makedir(cache_dir)
+
+        # the features only depend on the experiment, not on the cell
+        features_split = OrderedDict(
+            (expname, self.split_features(self.features[expname]))
+            for expname in self.features)
+
         for i_cell, cellname in enumerate(self.dataset):
 
             dataset_cell_exp = self.dataset[cellname]['experiments']
@@ -488,7 +568,7 @@ class Extractor(object):
                 toffs = dataset_cell_exp[expname]['toff']
                 amps = dataset_cell_exp[expname]['amp']
 
-                features_all = self.features[expname] + ['peak_time']
+                features_all, features_all_ = features_split[expname]
 
                 if 'threshold' in self.cells[cellname]['experiments'][expname]:
                     threshold = self.cells[cellname][
@@ -501,29 +581,71 @@ class Extractor(object):
                     dataset_cell_exp[expname]['features'][feature] = []
                 dataset_cell_exp[expname]['features']['numspikes'] = []
 
-                # iterate over all voltages individually to get features
-                # and correct them if needed
-                for i_seg in range(len(voltages)):
-
-                    trace = OrderedDict()
-                    trace['T'] = ts[i_seg]
-                    trace['V'] = voltages[i_seg]
-                    trace['stim_start'] = [tons[i_seg]]
-                    trace['stim_end'] = [toffs[i_seg]]
-                    traces = [trace]
-                    amp = amps[i_seg]
-
-                    efel.setDoubleSetting('stimulus_current', amp)
-
-                    features_all_ = [
-                        f for f in features_all
-                        if f not in self.extra_features]
-
-                    fel_vals = efel.getFeatureValues(
-                        traces, features_all_, raise_warnings=False)
+                # get the features of all the voltages in a single eFEL
+                # call. The stimulus amplitude differs between segments, so
+                # it is given in each trace rather than as a global setting
+                traces = []
+                # segments usually share their stimulus window, build the
+                # stim_start/stim_end lists once per window
+                stim_windows = {}
+                for t, v, ton, toff, amp in zip(
+                        ts, voltages, tons, toffs, amps):
+
+                    window = (ton, toff)
+                    if window not in stim_windows:
+                        stim_windows[window] = ([ton], [toff])
+                    stim_start, stim_end = stim_windows[window]
+
+                    traces.append({'T': t, 'V': v,
+                                   'stim_start': stim_start,
+                                   'stim_end': stim_end,
+                                   'stimulus_current': [amp]})
+
+                # the features of the individual traces are needed to print
+                # the table, do not use the cache in that case
+                features_cache = None
+                if cache_dir is not None and not print_table_flag:
+                    key = features_cache_key(traces, (
+                        features_all, self.options["amp_min"],
+                        self.options["peak_min"], trace_check,
+                        sorted(no_zeros_features),
+                        self.options.get('zero_to_nan')))
+                    # cell names can be nested directories, keep the cache
+                    # flat
+                    features_cache = os.path.join(
+                        cache_dir,
+                        cellname.replace('/', '_').replace(os.sep, '_') +
+                        '_' + expname + '_' + key + '.npz')
+
+                    features = load_features_cache(
+                        features_cache, dataset_cell_exp[expname]['features'])
+                    if features is not None:
+                        dataset_cell_exp[expname]['features'] = features
+                        continue
+
+                fel_vals_all = efel.getFeatureValues(
+                    traces, features_all_, raise_warnings=False)
+
+                # iterate over all voltages individually to correct the
+                # features if needed
+                for i_seg, (amp, ton, toff, fel_val) in enumerate(
+                        zip(amps, tons, toffs, fel_vals_all)):
+
+                    fel_vals = [fel_val]
 
                     peak_times = fel_vals[0]['peak_time']
 
+                    # the exclusion criteria only depend on the segment, not
+                    # on the feature, so evaluate them once per segment
+                    exclude_seg = abs(amp) < self.options["amp_min"]
+                    if trace_check and not exclude_seg:
+                        # exclude any activity outside stimulus (20 ms
+                        # grace period)
+                        peak_times_ = numpy.atleast_1d(peak_times)
+                        exclude_seg = (
+                            any(peak_times_ < ton) or
+                            any(peak_times_ > toff + 20))
+
                     for feature in features_all:
 
                         if feature == 'peak_time':
@@ -564,14 +686,12 @@ class Extractor(object):
                                 f = None
                         elif fel_vals[0][feature] is not None and \
                                 len(fel_vals[0][feature]) == 1 and \
-                                fel_vals[0][feature][0] == 0 and ZERO_TO_NAN \
-                                and feature in self.options[
-                                    'zero_to_nan'][
-                                    'mean_features_no_zeros']:
+                                fel_vals[0][feature][0] == 0 and \
+                                feature in no_zeros_features:
                             if self.options[
                                     'zero_to_nan']['value'] == 'stim_end':
-                                fel_vals[0][feature] = [toffs[i_seg]]
-                                f = [toffs[i_seg]]
+                                fel_vals[0][feature] = [toff]
+                                f = [toff]
                             elif self.options[
                                     'zero_to_nan']['value'] == 'nan':
                                 fel_vals[0][feature] = None
@@ -583,25 +703,13 @@ class Extractor(object):
                         else:
                             f = fel_vals[0][feature]
 
-                        if abs(amp) < self.options["amp_min"]:
+                        if exclude_seg:
                             f = float('nan')
                         elif f is not None:
-                            f = numpy.mean(f)
+                            f = feature_mean(f)
                         else:
                             f = float('nan')
 
-                        if "trace_check" in self.options and \
-                                self.options["trace_check"] is False:
-                            pass
-                        else:
-                            # exclude any activity outside stimulus (20 ms
-                            # grace period)
-                            if (any(numpy.atleast_1d(peak_times) <
-                                    trace['stim_start'][0]) or any(
-                                    numpy.atleast_1d(peak_times) >
-                                    trace['stim_end'][0] + 20)):
-                                f = float('nan')
-
                         dataset_cell_exp[expname]['features'][feature].append(
                             f)
 
@@ -631,14 +739,21 @@ class Extractor(object):
                                 cellname]['experiments'][
                                     expname][crr_filename],
                             amp=amp,
-                            stim_start=trace['stim_start'][0],
-                            stim_end=trace['stim_end'][0],
+                            stim_start=ton,
+                            stim_end=toff,
                         )
 
+                if features_cache is not None:
+                    save_features_cache(
+                        features_cache, dataset_cell_exp[expname]['features'])
+
     def mean_features(self):
         """Compute the mean for each features for each target"""
         logger.info(" Calculating mean features")
 
+        if 'expthreshold' in self.options:
+            expthreshold = frozenset(self.options['expthreshold'])
+
         # mean for each cell
         for i_cell, cellname in enumerate(self.dataset):
 
@@ -652,14 +767,14 @@ class Extractor(object):
 
                 for i_exp, expname in enumerate(dataset_cell_exp):
                     # use to determine threshold
-                    if expname in self.options['expthreshold']:
-                        hypamp = hypamp + dataset_cell_exp[expname]['hypamp']
-                        amp = amp + dataset_cell_exp[expname]['amp']
-                        numspikes = numspikes + dataset_cell_exp[expname][
-                            'features']['numspikes']
+                    if expname in expthreshold:
+                        hypamp.extend(dataset_cell_exp[expname]['hypamp'])
+                        amp.extend(dataset_cell_exp[expname]['amp'])
+                        numspikes.extend(dataset_cell_exp[expname][
+                            'features']['numspikes'])
 
                 mean_hypamp = self.newmeancell(numpy.array(hypamp))
-                amp_threshold = self.get_threshold(amp, numspikes)
+                amp_threshold = self.get_threshold(amp, numspikes, cellname)
 
                 self.thresholds_per_cell[cellname] = amp_threshold
                 self.hypamps_per_cell[cellname] = mean_hypamp
@@ -719,29 +834,30 @@ class Extractor(object):
                 toff = self.newmeancell(numpy.array(toff))
                 tend = self.newmeancell(numpy.array(tend))
 
-                hypamp = dataset_cell_exp[expname]['hypamp']
-                amp = dataset_cell_exp[expname]['amp']
-                numspikes = dataset_cell_exp[expname]['features']['numspikes']
+                # convert the amplitudes once, they are indexed for every
+                # target
+                hypamp = numpy.array(dataset_cell_exp[expname]['hypamp'])
+                amp = numpy.array(dataset_cell_exp[expname]['amp'])
                 feature_array = dataset_cell_exp[expname]['features']
 
-                rawfiles_list = dataset_cell_exp[expname]['rawfiles']
+                if self.saveraw:
+                    rawfiles = numpy.array(
+                        dataset_cell_exp[expname]['rawfiles'])
 
                 if self.options["relative"]:
                     amp_threshold = self.thresholds_per_cell[cellname]
-                    amp_rel = numpy.array(amp / amp_threshold * 100.)
+                    amp_rel = amp / amp_threshold * 100.
                 else:
-                    amp_rel = numpy.array(amp)
+                    amp_rel = amp
 
                 # absolute amplitude not relative to hypamp
-                amp_abs = numpy.abs(
-                    numpy.array(
-                        dataset_cell_exp[expname]['amp']) +
-                    numpy.array(
-                        dataset_cell_exp[expname]['hypamp']))
+                amp_abs = numpy.abs(amp + hypamp)
 
                 i_noinput = numpy.argmin(amp_abs)
 
-                # save amplitude results
+                # indices of the traces belonging to each target, shared by
+                # the amplitudes and all the features of the experiment
+                target_idx = []
                 for ti, target in enumerate(self.options["target"]):
 
                     if target == 'noinput':
@@ -749,20 +865,22 @@ class Extractor(object):
                     elif target == 'all':
                         idx = numpy.ones(len(amp), dtype=bool)
                     else:
-                        idx = numpy.array(
-                            (amp_rel >= (
-                                target -
-                                self.options["tolerance"][ti])) & (
-                                amp_rel <= (
-                                    target +
-                                    self.options["tolerance"][ti])))
-
-                    amp_target = numpy.atleast_1d(numpy.array(amp)[idx])
+                        tolerance = self.options["tolerance"][ti]
+                        idx = ((amp_rel >= target - tolerance) &
+                               (amp_rel <= target + tolerance))
+
+                    target_idx.append(idx)
+
+                # save amplitude results
+                for ti, target in enumerate(self.options["target"]):
+
+                    idx = target_idx[ti]
+
+                    amp_target = numpy.atleast_1d(amp[idx])
                     # equal to amp_target if amplitude not measured relative to
                     # threshold
-                    amp_rel_target = numpy.atleast_1d(
-                        numpy.array(amp_rel)[idx])
-                    hypamp_target = numpy.atleast_1d(numpy.array(hypamp)[idx])
+                    amp_rel_target = numpy.atleast_1d(amp_rel[idx])
+                    hypamp_target = numpy.atleast_1d(hypamp[idx])
 
                     if len(amp_target) > 0:
 
@@ -809,34 +927,34 @@ class Extractor(object):
                 dataset_cell_exp[expname]['mean_toff'] = toff
                 dataset_cell_exp[expname]['mean_tend'] = tend
 
+                # values of all the features (rows) for all the traces
+                # (columns), so that the traces of each target are selected
+                # and counted once for all the features
+                feat_matrix = numpy.array(
+                    [feature_array[feature]
+                     for feature in self.features[expname]],
+                    dtype=float).reshape(len(self.features[expname]),
+                                         len(amp))
+
+                target_feats = []
+                target_n = []
+                for idx in target_idx:
+                    feats = feat_matrix[:, numpy.atleast_1d(idx)]
+                    target_feats.append(feats)
+                    target_n.append(numpy.sum(~numpy.isnan(feats), axis=1))
+
                 for fi, feature in enumerate(self.features[expname]):
-                    feat_vals = numpy.array(feature_array[feature])
 
                     for ti, target in enumerate(self.options["target"]):
 
-                        if target == 'noinput':
-                            idx = numpy.array(i_noinput)
-                        elif target == 'all':
-                            idx = numpy.ones(len(amp), dtype=bool)
-                        else:
-                            idx = numpy.array(
-                                (amp_rel >= (
-                                    target -
-                                    self.options["tolerance"][ti])) & (
-                                    amp_rel <= (
-                                        target +
-                                        self.options["tolerance"][ti])))
+                        idx = target_idx[ti]
 
-                        feat = numpy.atleast_1d(numpy.array(feat_vals)[idx])
+                        feat = target_feats[ti][fi]
 
                         if self.saveraw:
-                            raw = numpy.atleast_1d(
-                                numpy.array(rawfiles_list)[idx]).tolist()
+                            raw = numpy.atleast_1d(rawfiles[idx]).tolist()
 
-                        n = numpy.sum(
-                            numpy.invert(
-                                numpy.isnan(
-                                    numpy.atleast_1d(feat))))
+                        n = target_n[ti][fi]
 
                         if n > 0:
 
@@ -1115,17 +1233,21 @@ class Extractor(object):
                     self.dataset_mean[expname]['bc_ld_features'][feature][
                         str(target)] = bcld
 
-    def get_threshold(self, amp, numspikes):
+    def get_threshold(self, amp, numspikes, cellname=None):
         """Get the spiking threshold of a cell by taking the smallest current
         amplitude for which it fires"""
-        isort = numpy.argsort(amp)
-        amps_sort = numpy.array(amp)[isort]
-        numspikes_sort = numpy.array(numspikes)[isort]
-        i_threshold = numpy.where(
-            numspikes_sort >= self.options["spike_threshold"])[0][0]
-        amp_threshold = amps_sort[i_threshold]
+        amps_spiking = [
+            a for a, n in zip(amp, numspikes)
+            if n >= self.options["spike_threshold"]]
 
-        return amp_threshold
+        if not amps_spiking:
+            raise ValueError(
+                "No trace of cell %s has at least %d spikes in the "
+                "expthreshold experiments %s, cannot get the threshold" % (
+                    cellname, self.options["spike_threshold"],
+                    list(self.options["expthreshold"])))
+
+        return min(amps_spiking)
 
     def plt_features(self):
         """Plot the features"""
@@ -1183,7 +1305,7 @@ class Extractor(object):
 
                 if self.options["relative"]:
                     amp_threshold = self.thresholds_per_cell[cellname]
-                    amp_rel = amp / amp_threshold * 100.
+                    amp_rel = numpy.array(amp) / amp_threshold * 100.
                 else:
                     amp_rel = amp
 
@@ -136,14 +136,8 @@ def process(config=None,
                 "The ABF file version is probably older than v2", filename)
 
     else:
-        # read metadata file if present
-        stim_feats = {}
-
-        f_meta = os.path.join(path, cellname, filename + '_metadata.json')
-        if os.path.exists(f_meta):
-            with open(f_meta) as json_metadata:
-                stim_feats = json.load(json_metadata)
-            json_metadata.close()
+        # metadata file already read above, if present
+        stim_feats = meta_dict
 
         # if metadata with stimulus info could be extracted
         if stim_feats:
@@ -185,7 +179,7 @@ def process(config=None,
             current = numpy.array(
                 seg.analogsignals[1]).astype(
                 numpy.float64).flatten()
-            t = numpy.arange(len(voltage)) * dt
+            t = common.manageSignals.time_vector(len(voltage), dt)
 
             ton = stim_info['ton']
             toff = stim_info['toff']
@@ -226,7 +220,7 @@ def process(config=None,
             if len(voltage) == 0:
                 continue
 
-            t = numpy.arange(len(voltage)) * dt
+            t = common.manageSignals.time_vector(len(voltage), dt)
             ton = all_stims["st"][i_seg]
             toff = all_stims["en"][i_seg]
             ion = int(ton / dt)
@@ -241,21 +235,20 @@ def process(config=None,
             if conv_fact != 1:
                 stim_u = "nA"
 
-            current = []
-            current = numpy.zeros(len(voltage))
-            current[ion:ioff] = amp
+            current = common.manageSignals.step_current(
+                len(voltage), ion, ioff, amp)
 
-            # estimate hyperpolarization current
-            hypamp = numpy.mean(current[0:ion])
+            # the synthesized step current is zero before the stimulus, no
+            # need to estimate the hyperpolarization current from it
+            hypamp = 0.0
 
             # 10% distance to measure step current
             iborder = int((ioff - ion) * 0.1)
 
             # clean voltage from transients
-            voltage[ion:ion + int(numpy.ceil(0.4 / dt))] = \
-                voltage[ion + int(numpy.ceil(0.4 / dt))]
-            voltage[ioff:ioff + int(numpy.ceil(0.4 / dt))] = \
-                voltage[ioff + int(numpy.ceil(0.4 / dt))]
+            n_transient = int(numpy.ceil(0.4 / dt))
+            voltage[ion:ion + n_transient] = voltage[ion + n_transient]
+            voltage[ioff:ioff + n_transient] = voltage[ioff + n_transient]
 
         # normalize membrane potential to known value
         # (given in UCL excel sheet)
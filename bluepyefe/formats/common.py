@@ -9,6 +9,7 @@ import six
 import logging
 logger = logging.getLogger(__name__)
 import quantities as pq
+import numpy
 
 
 class manageFiles:
@@ -421,20 +422,19 @@ class manageMetadata:
 
         holding_current = {}
 
-        if hca and hcu in crr_dict:
-
-            chca = crr_dict[hca]
-            chcu = crr_dict[hcu]
-
-            if chca and chcu:
-                chca = chca[0] * manageConfig.conversion_factor(amp_unit, chcu)
-                holding_current = {
-                    "holdcurr": {
-                        "value": [chca], "holdcurru": amp_unit,
-                        "message": "Applied holding current: " + str(chca) +
-                        " " + amp_unit
-                    }
+        # both the value and its unit are needed
+        chca = crr_dict.get(hca)
+        chcu = crr_dict.get(hcu)
+
+        if chca and chcu:
+            chca = chca[0] * manageConfig.conversion_factor(amp_unit, chcu)
+            holding_current = {
+                "holdcurr": {
+                    "value": [chca], "holdcurru": amp_unit,
+                    "message": "Applied holding current: " + str(chca) +
+                    " " + amp_unit
                 }
+            }
         return holding_current
 
 
@@ -455,27 +455,28 @@ class manageConfig():
     # all units
     all_units = cu + vu + fu
 
+    # conversion factors, keyed by "unit_to-unit_from"
+    conversion_table = {
+        "v-mv": 1 / 1e3, "mv-v": 1e3, "a-da": 1 / 10, "a-ca": 1 / 1e2,
+        "a-ma": 1 / 1e3, "a-ua": 1 / 1e6, "a-na": 1 / 1e9,
+        "a-pa": 1 / 1e12, "da-a": 1 / 10, "da-ca": 10, "da-ma": 1e2,
+        "da-ua": 1e5, "da-na": 1e8, "da-pa": 1e11, "ca-a": 1 / 1e2,
+        "ca-da": 1 / 10, "ca-ma": 10, "ca-ua": 1e4, "ca-na": 1e7,
+        "ca-pa": 1e10, "na-a": 1e9, "na-da": 1e8, "na-ca": 1e7,
+        "na-ma": 1e6, "na-ua": 1e3, "na-pa": 1 / 1e3, "ma-a": 1e3,
+        "ma-da": 1e2, "ma-ca": 10, "ma-ua": 1 / 1e3, "ma-na": 1e6,
+        "ma-pa": 1e9, "ua-a": 1 / 1e6, "ua-da": 1 / 1e5, "ua-ca": 1 / 1e4,
+        "ua-ma": 1 / 1e3, "ua-na": 1e3, "ua-pa": 1e6, "pa-a": 1e12,
+        "pa-da": 1e11, "pa-ca": 1e10, "pa-ma": 1e9, "pa-ua": 1e6,
+        "pa-na": 1e3, "khz-hz": 1 / 1e3, "hz-khz": 1e3,
+    }
+
     @classmethod
     def conversion_factor(cls, unit_to, unit_from):
         """
         Extract conversion factors from unit_two to unit_one
         """
 
-        conversion_table = {
-            "v-mv": 1 / 1e3, "mv-v": 1e3, "a-da": 1 / 10, "a-ca": 1 / 1e2,
-            "a-ma": 1 / 1e3, "a-ua": 1 / 1e6, "a-na": 1 / 1e9,
-            "a-pa": 1 / 1e12, "da-a": 1 / 10, "da-ca": 10, "da-ma": 1e2,
-            "da-ua": 1e5, "da-na": 1e8, "da-pa": 1e11, "ca-a": 1 / 1e2,
-            "ca-da": 1 / 10, "ca-ma": 10, "ca-ua": 1e4, "ca-na": 1e7,
-            "ca-pa": 1e10, "na-a": 1e9, "na-da": 1e8, "na-ca": 1e7,
-            "na-ma": 1e6, "na-ua": 1e3, "na-pa": 1 / 1e3, "ma-a": 1e3,
-            "ma-da": 1e2, "ma-ca": 10, "ma-ua": 1 / 1e3, "ma-na": 1e6,
-            "ma-pa": 1e9, "ua-a": 1 / 1e6, "ua-da": 1 / 1e5, "ua-ca": 1 / 1e4,
-            "ua-ma": 1 / 1e3, "ua-na": 1e3, "ua-pa": 1e6, "pa-a": 1e12,
-            "pa-da": 1e11, "pa-ca": 1e10, "pa-ma": 1e9, "pa-ua": 1e6,
-            "pa-na": 1e3, "khz-hz": 1 / 1e3, "hz-khz": 1e3,
-        }
-
         conv_string = unit_to.lower() + "-" + unit_from.lower()
 
         if unit_to.lower() == unit_from.lower():
@@ -483,11 +484,11 @@ class manageConfig():
 
         elif unit_to.lower() not in cls.all_units or \
                 unit_from.lower() not in cls.all_units or \
-                conv_string not in conversion_table:
+                conv_string not in cls.conversion_table:
             raise ValueError(
                 "Given unit/s cannot be converted. Program is exiting")
         else:
-            return conversion_table[conv_string]
+            return cls.conversion_table[conv_string]
 
     @classmethod
     def get_exclude_values(cls, cells_cellname, idx_file):
@@ -572,3 +573,30 @@ class manageDicts():
         data['filename'].append(filename)
 
         return True
+
+
+class manageSignals():
+
+    @classmethod
+    def time_vector(cls, length, dt):
+        """
+        Build the time vector (in ms) of a trace sampled every dt ms.
+        The array is scaled in place to avoid allocating a temporary
+        """
+
+        t = numpy.arange(length, dtype=numpy.float64)
+        t *= dt
+
+        return t
+
+    @classmethod
+    def step_current(cls, length, ion, ioff, amp):
+        """
+        Synthesize a step current of amplitude amp between the indices ion
+        and ioff, zero elsewhere
+        """
+
+        current = numpy.zeros(length)
+        current[ion:ioff] = amp
+
+        return current
@@ -26,6 +26,8 @@ import logging
 logger = logging.getLogger(__name__)
 import numpy
 
+from . import common
+
 
 def process(config=None,
             filename=None,
@@ -78,42 +80,43 @@ def process(config=None,
         columns = list(zip(*reader))
         length = numpy.shape(columns)[1]
 
-        for ic, column in enumerate(columns):
+        # the last 100 ms are removed, only parse and allocate the part of
+        # the recordings which is kept
+        n_keep = max(length - int(100. / dt), 0)
+        t = common.manageSignals.time_vector(n_keep, dt)
+        ion = int(ton / dt)
+        ioff = int(toff / dt)
 
-            voltage = numpy.zeros(length)
-            for istr, string in enumerate(column):
-                if (string != "-") and (string != ""):
-                    voltage[istr] = float(string)
+        for ic, column in enumerate(columns):
 
-            t = numpy.arange(len(voltage)) * dt
             amp = amplitudes[ic]
-            voltage = voltage - ljp  # correct liquid junction potential
-
-            # remove last 100 ms
-            voltage = voltage[0:int(-100. / dt)]
-            t = t[0:int(-100. / dt)]
-            ion = int(ton / dt)
-            ioff = int(toff / dt)
-            current = []
-            current = numpy.zeros(len(voltage))
-            current[ion:ioff] = amp
 
             if ('exclude' in cells[cellname] and
                 any(abs(cells[cellname]['exclude'][idx_file] - amp) <
                     1e-4)):
 
                 logger.info(" Not using trace with amplitude %f", amp)
+                continue
+
+            voltage = numpy.zeros(n_keep)
+            for istr, string in enumerate(column[0:n_keep]):
+                if (string != "-") and (string != ""):
+                    voltage[istr] = float(string)
+
+            voltage -= ljp  # correct liquid junction potential
+
+            current = common.manageSignals.step_current(
+                n_keep, ion, ioff, amp)
+
+            data['voltage'].append(voltage)
+            data['current'].append(current)
+            data['t'].append(t)
 
-            else:
-                data['voltage'].append(voltage)
-                data['current'].append(current)
-                data['t'].append(t)
-
-                data['dt'].append(numpy.float(dt))
-                data['ton'].append(numpy.float(ton))
-                data['toff'].append(numpy.float(toff))
-                data['amp'].append(numpy.float(amp))
-                data['hypamp'].append(numpy.float(hypamp))
-                data['filename'].append(filename)
+            data['dt'].append(numpy.float(dt))
+            data['ton'].append(numpy.float(ton))
+            data['toff'].append(numpy.float(toff))
+            data['amp'].append(numpy.float(amp))
+            data['hypamp'].append(numpy.float(hypamp))
+            data['filename'].append(filename)
 
     return data
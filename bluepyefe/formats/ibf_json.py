@@ -25,6 +25,8 @@ import json
 
 from collections import OrderedDict
 
+from . import common
+
 import logging
 
 logger = logging.getLogger(__name__)
@@ -77,7 +79,7 @@ def process(config=None,
     for idx, value in f_data['traces'].items():
         crr_amp = idx
         voltage = numpy.array(value).astype(numpy.float64)
-        t = numpy.arange(len(voltage)) * dt
+        t = common.manageSignals.time_vector(len(voltage), dt)
 
         ton = f_data['tonoff'][idx]['ton'][0]
         toff = f_data['tonoff'][idx]['toff'][0]
@@ -85,12 +87,12 @@ def process(config=None,
         ioff = int(toff / dt)
         amp = numpy.float64(idx)
 
-        current = []
-        current = numpy.zeros(len(voltage))
-        current[ion:ioff] = amp
+        current = common.manageSignals.step_current(
+            len(voltage), ion, ioff, amp)
 
-        # estimate hyperpolarization current
-        hypamp = numpy.mean(current[0:ion])
+        # the synthesized step current is zero before the stimulus, no
+        # need to estimate the hyperpolarization current from it
+        hypamp = 0.0
 
         # 10% distance to measure step current
         iborder = int((ioff - ion) * 0.1)
@@ -100,10 +102,9 @@ def process(config=None,
         voltage_dirty = voltage[:]
 
         # clean voltage from transients
-        voltage[ion:ion + int(numpy.ceil(0.4 / dt))] = voltage[
-            ion + int(numpy.ceil(0.4 / dt))]
-        voltage[ioff:ioff + int(numpy.ceil(0.4 / dt))] = voltage[
-            ioff + int(numpy.ceil(0.4 / dt))]
+        n_transient = int(numpy.ceil(0.4 / dt))
+        voltage[ion:ion + n_transient] = voltage[ion + n_transient]
+        voltage[ioff:ioff + n_transient] = voltage[ioff + n_transient]
 
         # normalize membrane potential to known value (given in UCL
         # excel sheet)
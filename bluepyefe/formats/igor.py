@@ -19,8 +19,10 @@ Copyright (c) 2020, EPFL/Blue Brain Project
  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """
 
+import math
 import numpy
 from . import igorpy
+from . import common
 from collections import OrderedDict
 
 import logging
@@ -96,7 +98,7 @@ def process(config=None,
 
     if (t_unit == "") or (t_unit == "s"):
         dt = dt * 1e3  # convert to ms
-    t = dt * numpy.arange(0, len(wave))
+    t = common.manageSignals.time_vector(len(wave), dt)
 
     notes, wave = igorpy.read(i_file)
 
@@ -129,7 +131,7 @@ def process(config=None,
 
     if expname in ['APThreshold']:
         imax = numpy.argmax(i)
-        toff = t[imax]
+        toff = imax * dt
         trun = toff - ton
         ampoff = numpy.mean(i[int(imax - 10. / dt):imax]) - hypamp
         # extrapolate to get expected amplitude at 1 sec
@@ -149,10 +151,10 @@ def process(config=None,
 
     # clean voltage from transients
     if expname in ['IDRest', 'IDrest', 'IDthresh', 'IDdepol']:
-        cut_start = int(ion + numpy.ceil(1.0 / dt))
+        cut_start = int(ion + math.ceil(1.0 / dt))
         v[ion:cut_start] = v[cut_start]
-        cut_end0 = int(ioff - numpy.ceil(0.5 / dt))
-        cut_end1 = int(ioff + numpy.ceil(2.0 / dt))
+        cut_end0 = int(ioff - math.ceil(0.5 / dt))
+        cut_end1 = int(ioff + math.ceil(2.0 / dt))
         v[cut_end0:cut_end1] = v[cut_end1]
 
     # delete second pulse
@@ -20,7 +20,7 @@ Copyright (c) 2020, EPFL/Blue Brain Project
 """
 
 from neo import io
-from collections import OrderedDict
+from collections import OrderedDict, Counter
 import logging
 logger = logging.getLogger(__name__)
 import numpy as np
@@ -107,16 +107,19 @@ def process(config=None,
         meta_dict, "nA")
     stim = set_units(stim, conv_factor, "nA")  # add dimension to signal
 
-    stim = stim - holding_current["holdcurr"]["value"] * stim.units
+    # no holding current to remove if it is missing from the metadata
+    if holding_current:
+        stim = stim - holding_current["holdcurr"]["value"] * stim.units
+    else:
+        logger.warning(
+            " No holding current given for %s, not applying any", filename)
 
     stim = stim.flatten()[::stim_channel[1] + 1]
     stimulus_threshold = stimulus_threshold * conv_factor
 
     # find edges of the signal where different stimulus steps are located
     step_edges = []
-    for idx_sts in range(len(stimulus_start)):
-        sts = stimulus_start[idx_sts]
-        ste = stimulus_end[idx_sts]
+    for idx_sts, (sts, ste) in enumerate(zip(stimulus_start, stimulus_end)):
         se = find_stimulus_steps(
             stim.time_slice(sts, ste),
             stimulus_threshold
@@ -191,12 +194,12 @@ def process(config=None,
         amp = np.float64(str("{0:.2f}".format(amp)))
 
         # creating current signal
-        current = []
-        current = np.zeros(len(voltage))
-        current[ion:ioff] = amp
+        current = common.manageSignals.step_current(
+            len(voltage), ion, ioff, amp)
 
-        # estimate hyperpolarization current
-        hypamp = np.mean(current[0:ion])
+        # the synthesized step current is zero before the stimulus, no
+        # need to estimate the hyperpolarization current from it
+        hypamp = 0.0
 
         # convert voltage from AnalogSignal to list
         voltage = np.array(voltage.tolist()).astype(np.float64)
@@ -443,7 +446,11 @@ def extract_amp_from_sig(signal, onset, offset, cut):
 
     signal_cut = signal.time_slice(onset, onset + cut * ms)
     signal_cut = signal_cut.flatten().magnitude.tolist()
-    amp = float(max(signal_cut, key=signal_cut.count))
+
+    # most frequent value of the slice, counted in a single pass. max keeps
+    # the first of the tied values, as Counter order is not defined in py27
+    counts = Counter(signal_cut)
+    amp = float(max(signal_cut, key=counts.__getitem__))
 
     return amp
 
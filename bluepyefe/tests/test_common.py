@@ -0,0 +1,37 @@
+"""Test format helper functions"""
+
+"""
+Copyright (c) 2020, EPFL/Blue Brain Project
+
+ This file is part of BluePyEfe <https://github.com/BlueBrain/BluePyEfe>
+
+ This library is free software; you can redistribute it and/or modify it under
+ the terms of the GNU Lesser General Public License version 3.0 as published
+ by the Free Software Foundation.
+
+ This library is distributed in the hope that it will be useful, but WITHOUT
+ ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+ FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+ details.
+
+ You should have received a copy of the GNU Lesser General Public License
+ along with this library; if not, write to the Free Software Foundation, Inc.,
+ 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+
+from bluepyefe.formats import common
+
+
+def test_holding_current():
+    """Test holding current with and without value in the metadata"""
+
+    get_holding_current = common.manageMetadata.get_holding_current
+
+    assert get_holding_current({}, "nA") == {}
+    assert get_holding_current({"holding_current_unit": "pA"}, "nA") == {}
+    assert get_holding_current({"holding_current": [10.]}, "nA") == {}
+
+    holding_current = get_holding_current(
+        {"holding_current": [10.], "holding_current_unit": "pA"}, "nA")
+    assert holding_current["holdcurr"]["value"] == [10. * 1e-3]
+    assert holding_current["holdcurr"]["holdcurru"] == "nA"
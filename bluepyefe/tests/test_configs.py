@@ -23,6 +23,8 @@ import os
 import json
 import glob
 
+import numpy
+
 import bluepyefe as bpefe
 
 
@@ -34,9 +36,11 @@ def pytest_generate_tests(metafunc):
 
     config_paths = glob.glob(os.path.join(configs_dir, '*.json'))
 
-    metafunc.parametrize("rootdir,config_path",
-                         ((rootdir, config_path)
-                          for config_path in config_paths), ids=config_paths)
+    if 'config_path' in metafunc.fixturenames:
+        metafunc.parametrize("rootdir,config_path",
+                             ((rootdir, config_path)
+                              for config_path in config_paths),
+                             ids=config_paths)
 
 
 def test_config(rootdir, config_path):
@@ -68,3 +72,56 @@ def test_config(rootdir, config_path):
     extractor.feature_config_cells(version='legacy')
     extractor.feature_config_all(version='legacy')
     '''
+
+
+def test_features_cache(tmpdir, monkeypatch):
+    """Test that cached features are reused and match uncached ones"""
+
+    rootdir = os.path.dirname(os.path.abspath(__file__))
+    config_path = os.path.join(
+        rootdir, 'configs_cache', 'csv_cache.json')
+
+    def extract(cache_dir):
+        config = json.load(open(config_path))
+        config['path'] = os.path.join(rootdir, config['path'])
+        config['options']['cache_dir'] = cache_dir
+
+        extractor = bpefe.Extractor('test_run', config)
+        extractor.create_dataset()
+        extractor.extract_features(threshold=-30)
+        extractor.mean_features()
+
+        return extractor
+
+    cache_dir = str(tmpdir.join('cache'))
+
+    reference = extract(None)
+    extract(cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # eFEL must not be called when the features are in the cache
+    def fail(*args, **kwargs):
+        raise AssertionError("eFEL called despite the cache")
+    monkeypatch.setattr(bpefe.extractor.efel, 'getFeatureValues', fail)
+    cached = extract(cache_dir)
+    monkeypatch.undo()
+
+    for cellname, cell in reference.dataset.items():
+        for expname, exp in cell['experiments'].items():
+            features = exp['features']
+            cached_features = cached.dataset[cellname]['experiments'][
+                expname]['features']
+            assert list(features) == list(cached_features)
+            for feature in features:
+                numpy.testing.assert_array_equal(
+                    numpy.array(features[feature], dtype=float),
+                    numpy.array(cached_features[feature], dtype=float))
+
+    # a corrupt cache file is ignored and overwritten
+    cache_file = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    with open(cache_file, 'wb') as f:
+        f.write(b'corrupt')
+    extract(cache_dir)
+    assert os.listdir(cache_dir) == [os.path.basename(cache_file)]
+    with numpy.load(cache_file) as cached_file:
+        assert 'numspikes' in cached_file